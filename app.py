@@ -1,17 +1,27 @@
 import streamlit as st
+import asyncio
 import datetime
 import json
+import os
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from io import BytesIO
-from sentence_transformers import SentenceTransformer
+from itertools import zip_longest
+import numpy as np
 import weaviate
-from weaviate.auth import AuthApiKey
-import groq
-from docx import Document
-import gspread
+from weaviate.classes.init import AdditionalConfig, Auth, Timeout
+from weaviate.exceptions import WeaviateBaseError
+from pydantic import BaseModel, ConfigDict, ValidationError
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from google.auth.exceptions import TransportError
+import httplib2
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- CONFIGURATION ---
 
@@ -21,25 +31,261 @@ WEAVIATE_API_KEY = st.secrets["api_keys"]["WEAVIATE_API_KEY"]
 GROQ_API_KEY = st.secrets["api_keys"]["GROQ_API_KEY"]
 INDEX_NAME = "tcmapp"  # Adjust as needed if your Weaviate index name is different
 
+# Embedding model. If the int8-quantized ONNX export exists it is used instead of FP32 PyTorch; create it once with:
+#   optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 --task feature-extraction models/minilm
+#   python -c "from onnxruntime.quantization import quantize_dynamic, QuantType; quantize_dynamic('models/minilm/model.onnx', 'models/minilm_int8.onnx', weight_type=QuantType.QInt8)"
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_MODEL_PATH = "models/minilm_int8.onnx"
+# Run the PyTorch fallback in bfloat16. Only worth it on CPUs with native bf16 (AVX-512 BF16 / AMX);
+# check cosine scores against the FP32 model before turning it on.
+EMBEDDING_BFLOAT16 = False
+# MiniLM was trained on 128-token inputs; the library default of 256 only pads and attends over
+# more tokens for the long all-fields queries without matching how the model was trained
+EMBEDDING_MAX_SEQ_LENGTH = 128
+
+# Retrieval limits: drop weak matches and bound the context fed into each Groq prompt
+MIN_SIMILARITY = 0.55
+# Part of the persisted search cache key. Bump it after re-indexing the TCMApp collection so
+# results cached on disk from the old index are no longer served.
+RETRIEVAL_CACHE_VERSION = 1
+# Everything besides the query text that shapes a cached search result, so changing the model,
+# its input length or the similarity cut-off can never serve stale neighbours from disk
+RETRIEVAL_CACHE_KEY = (RETRIEVAL_CACHE_VERSION, EMBEDDING_MODEL_NAME, EMBEDDING_MAX_SEQ_LENGTH, MIN_SIMILARITY)
+MAX_CONTEXT_CHARS = 6000
+# Per-section extras ride on top of the shared prefix in every request, so they get a tighter cap
+SECTION_CONTEXT_CHARS = 2000
+
+# Clinical fields that drive retrieval. Identity, pulse rate and report bookkeeping are left out
+# so they neither dilute the query nor invalidate cached embeddings when they change.
+RETRIEVAL_FIELDS = (
+    'Gender',
+    'Chief Complaint',
+    'Duration of Complaint',
+    'Complexion',
+    'Tongue Color',
+    'Tongue Coating',
+    'Tongue Shape and Features',
+    'Voice Sound',
+    'Breath Odor',
+    'Cold/Heat Sensation',
+    'Sweating',
+    'Appetite and Thirst',
+    'Sleep Pattern',
+    'Bowel Movements',
+    'Urination',
+    'Pain (location, nature, factors that alleviate or aggravate)',
+    'Pulse Quality',
+    'Emotional State',
+    'Lifestyle Factors (diet, exercise, stress, etc.)',
+    'Relevant Medical History',
+)
+
+# Form values that mean "nothing recorded" and so are kept out of retrieval queries
+RETRIEVAL_PLACEHOLDER_VALUES = frozenset({"Not observed"})
+
+# Facets of the presentation queried separately for the shared context, so each gets its own neighbours
+RETRIEVAL_FIELD_GROUPS = (
+    ('Chief Complaint', 'Duration of Complaint', 'Pain (location, nature, factors that alleviate or aggravate)'),
+    ('Complexion', 'Tongue Color', 'Tongue Coating', 'Tongue Shape and Features'),
+    ('Pulse Quality', 'Cold/Heat Sensation', 'Sweating'),
+    ('Appetite and Thirst', 'Sleep Pattern', 'Bowel Movements', 'Urination', 'Emotional State'),
+)
+
+# Sheet column -> form widget key, in sheet column order. The widgets keep their own values in
+# st.session_state, so the patient record is only assembled when a button needs it.
+# Age has no widget of its own; sync_patient_info derives it from the date of birth.
+PATIENT_FIELD_KEYS = {
+    'Patient Name': 'name',
+    'Date of Birth (DD/MM/YY)': 'dob',
+    'Gender': 'gender',
+    'Chief Complaint': 'chief_complaint',
+    'Duration of Complaint': 'complaint_duration',
+    'Complexion': 'complexion',
+    'Tongue Color': 'tongue_color',
+    'Tongue Coating': 'tongue_coating',
+    'Tongue Shape and Features': 'tongue_shape',
+    'Voice Sound': 'voice_sound',
+    'Breath Odor': 'breath_odor',
+    'Cold/Heat Sensation': 'cold_heat_sensation',
+    'Sweating': 'sweating',
+    'Appetite and Thirst': 'appetite',
+    'Sleep Pattern': 'sleep',
+    'Bowel Movements': 'bowel_movements',
+    'Urination': 'urination',
+    'Pain (location, nature, factors that alleviate or aggravate)': 'pain',
+    'Pulse Rate (BPM)': 'pulse_rate',
+    'Pulse Quality': 'pulse_quality',
+    'Emotional State': 'emotions',
+    'Lifestyle Factors (diet, exercise, stress, etc.)': 'lifestyle',
+    'Relevant Medical History': 'medical_history',
+}
+
+# Select box options, with value -> index lookups for restoring a stored choice
+GENDER_OPTIONS = ("Male", "Female", "Other")
+GENDER_INDEX = {option: i for i, option in enumerate(GENDER_OPTIONS)}
+TONGUE_COLOR_OPTIONS = ("Not observed", "Pale", "Red", "Dark Red", "Purple", "Bluish Purple")
+TONGUE_COLOR_INDEX = {option: i for i, option in enumerate(TONGUE_COLOR_OPTIONS)}
+TONGUE_COATING_OPTIONS = ("Not observed", "Thin White", "Thick White", "Yellow", "Grey", "Black")
+TONGUE_COATING_INDEX = {option: i for i, option in enumerate(TONGUE_COATING_OPTIONS)}
+COLD_HEAT_OPTIONS = ("Aversion to Cold", "Aversion to Heat", "Alternating Cold and Heat", "Normal")
+COLD_HEAT_INDEX = {option: i for i, option in enumerate(COLD_HEAT_OPTIONS)}
+PULSE_QUALITY_OPTIONS = ("Floating", "Sinking", "Slow", "Rapid", "Strong", "Weak", "Wiry", "Slippery", "Rough")
+
+# Upper bound on Groq calls in flight for one report
+MAX_CONCURRENT_SECTIONS = 4
+
+# Report sections in order, with a completion budget sized to each section's typical length
+REPORT_SECTION_MAX_TOKENS = {
+    "1. Patient Overview": 600,
+    "2. TCM Diagnosis": 1500,
+    "3. Pattern Differentiation": 1200,
+    "4. Treatment Principle and Plan": 1200,
+    "5. Acupuncture Point Prescription": 1000,
+    "6. Herbal Formula Recommendation": 1500,
+    "7. Lifestyle and Dietary Advice": 1000,
+    "8. Prognosis and Follow-up Recommendations": 600,
+}
+
 GOOGLE_SHEETS_CREDENTIALS = st.secrets["gcp_service_account"]
 SHEET_ID = st.secrets["google_sheets"]["sheet_id"]
 
-# Initialize Weaviate client
-auth = AuthApiKey(api_key=WEAVIATE_API_KEY)
-weaviate_client = weaviate.Client(WEAVIATE_URL, auth_client_secret=auth)
-
 # --- UTILITY FUNCTIONS ---
 
+# Looked up once per script run instead of on every age calculation
+TODAY = datetime.date.today()
+
 def calculate_age(born):
-    today = datetime.date.today()
-    return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+    return TODAY.year - born.year - (1 if (TODAY.month, TODAY.day) < (born.month, born.day) else 0)
+
+def parse_dob(text):
+    # DOBs are written as DD/MM/YYYY; older rows hold DD/MM/YY, which strptime maps 00-68 to
+    # 2000-2068, so a two-digit year that lands in the future belongs to the previous century
+    try:
+        return datetime.datetime.strptime(text, "%d/%m/%Y").date()
+    except ValueError:
+        born = datetime.datetime.strptime(text, "%d/%m/%y").date()
+        return born.replace(year=born.year - 100) if born > TODAY else born
 
 def clear_patient_data():
     st.session_state.patient_info = {}
     st.session_state.generated_report = None
     st.success("Patient data has been cleared.")
 
+def sync_patient_info():
+    # Copy the form's current widget values into the stored patient record
+    if PATIENT_FIELD_KEYS['Patient Name'] not in st.session_state:
+        return
+    form_values = {column: st.session_state.get(key) for column, key in PATIENT_FIELD_KEYS.items()}
+    dob = form_values['Date of Birth (DD/MM/YY)']
+    form_values['Date of Birth (DD/MM/YY)'] = dob.strftime("%d/%m/%Y")
+    form_values['Age'] = str(calculate_age(dob))
+    form_values['Pulse Rate (BPM)'] = str(form_values['Pulse Rate (BPM)'])
+    form_values['Pulse Quality'] = ', '.join(form_values['Pulse Quality'] or [])  # Comma-separated string for multiselect
+    st.session_state.patient_info.update(form_values)
+
+class OnnxEmbeddingModel:
+    """int8 MiniLM on ONNX Runtime, exposing the part of SentenceTransformer.encode this app uses."""
+
+    def __init__(self, model_path, tokenizer_name, max_seq_length=256):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = os.cpu_count() or 1
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        self.max_seq_length = max_seq_length
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        # Smart batching as in sentence-transformers: sort by length so each batch pads only to its
+        # own longest sentence, then restore the caller's order at the end
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        sorted_sentences = [sentences[i] for i in order]
+
+        batches = []
+        for start in range(0, len(sorted_sentences), batch_size):
+            inputs = self.tokenizer(sorted_sentences[start:start + batch_size], padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np")
+            token_embeddings = self.session.run(None, {name: inputs[name].astype(np.int64) for name in self.input_names})[0]
+            # Mean-pool over real tokens only, as the sentence-transformers pooling layer does
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            batches.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+
+        embeddings = np.empty((len(sentences), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.concatenate(batches)
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
+
+def load_embedding_model():
+    # The model stack (torch, transformers, onnxruntime) is imported here rather than at the top
+    # of the script, so a cold start only pays for it when the model is first built
+    if os.path.exists(ONNX_MODEL_PATH):
+        embedding_model = OnnxEmbeddingModel(ONNX_MODEL_PATH, EMBEDDING_MODEL_NAME, max_seq_length=EMBEDDING_MAX_SEQ_LENGTH)
+    else:
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        # Containers often default torch to a single thread
+        torch.set_num_threads(os.cpu_count() or 1)
+        try:
+            torch.set_num_interop_threads(2)
+        except RuntimeError:
+            pass  # Can only be set once per process, before any inter-op work; keep the existing value
+        # PyTorch's fused scaled-dot-product attention kernel instead of the eager attention path
+        embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, model_kwargs={"attn_implementation": "sdpa"})
+        embedding_model.max_seq_length = EMBEDDING_MAX_SEQ_LENGTH
+        embedding_model.eval()
+        if EMBEDDING_BFLOAT16:
+            transformer = embedding_model[0]
+            transformer.auto_model = transformer.auto_model.to(torch.bfloat16)
+            # Upcast before pooling so mean-pooling, normalization and numpy conversion stay in FP32
+            transformer.register_forward_hook(
+                lambda module, inputs, features: features.update(token_embeddings=features["token_embeddings"].float())
+            )
+
+    # Pay the first-call setup (tokenizer init, kernel selection, allocator growth) while the
+    # resource is being cached rather than on the first user's report
+    embedding_model.encode(["warmup sentence for kernel init"], convert_to_numpy=True)
+    return embedding_model
+
+# Client and model initialization, cached so Streamlit reruns reuse them
+@st.cache_resource
+def init_resources():
+    # Loading the model (disk/download + warmup) overlaps the Weaviate client's connection handshake
+    executor = ThreadPoolExecutor(max_workers=1)
+    model_future = executor.submit(load_embedding_model)
+    try:
+        # The v4 client queries over gRPC, so vectors travel as packed floats rather than JSON.
+        # Short init/query timeouts so a stalled search fails fast.
+        weaviate_client = weaviate.connect_to_weaviate_cloud(
+            cluster_url=WEAVIATE_URL,
+            auth_credentials=Auth.api_key(WEAVIATE_API_KEY),
+            additional_config=AdditionalConfig(timeout=Timeout(init=5, query=10)),
+        )
+    except Exception:
+        # Fail now rather than wait for a model this failed init would throw away
+        model_future.cancel()
+        executor.shutdown(wait=False)
+        raise
+
+    try:
+        embedding_model = model_future.result()
+    except Exception:
+        # A failed init isn't cached, so the next rerun would otherwise leak another connection
+        weaviate_client.close()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+    return weaviate_client, embedding_model
+
 # Google API Initialization
+@st.cache_resource
 def initialize_google_services():
     creds = Credentials.from_service_account_info(
         GOOGLE_SHEETS_CREDENTIALS,
@@ -53,40 +299,75 @@ def initialize_google_services():
     drive_service = build("drive", "v3", credentials=creds)
     return sheets_service, docs_service, drive_service
 
+# Whole patient sheet in a single read, cached briefly and cleared after every write
+@st.cache_data(ttl=60, show_spinner=False)
+def load_patients(_sheets_service):
+    result = (
+        _sheets_service.spreadsheets()
+        .values()
+        .get(spreadsheetId=SHEET_ID, range="A:Z")
+        .execute()
+    )
+    values = result.get("values", [])
+    headers = values[0] if values else []
+    names = []
+    patients = {}  # exact name -> (first sheet row number, record); saves only match exactly
+    patients_by_folded_name = {}  # casefolded name -> same entry, for the case-insensitive search
+    for row_number, row in enumerate(values[1:], start=2):
+        if row and row[0]:
+            names.append(row[0])
+            entry = (row_number, dict(zip(headers, row)))
+            patients.setdefault(row[0], entry)
+            patients_by_folded_name.setdefault(row[0].casefold(), entry)
+    return headers, names, patients, patients_by_folded_name
+
 # Patient Search Function
 def search_patient(sheets_service, name):
-    try:
-        result = (
-            sheets_service.spreadsheets()
-            .values()
-            .get(spreadsheetId=SHEET_ID, range="A:Z")
-            .execute()
-        )
-        values = result.get("values", [])
-        headers = values[0]
-        for row in values[1:]:
-            if row[0].lower() == name.lower():
-                patient_data = dict(zip(headers, row))
-                # Check if there's a report ID and fetch the report content
-                if 'Report ID' in patient_data and patient_data['Report ID']:
-                    report_content = get_report_content(docs_service, patient_data['Report ID'])
-                    patient_data['Report Content'] = report_content
-                return patient_data
+    if not name.strip():
         return None
-    except Exception as e:
+    try:
+        _, _, _, patients_by_folded_name = load_patients(sheets_service)
+    except (HttpError, TransportError, httplib2.HttpLib2Error, OSError) as e:
+        # API errors plus network failures (OSError covers timeouts); anything else is a bug
         st.error(f"Error searching for patient: {e}")
         return None
 
+    match = patients_by_folded_name.get(name.casefold())
+    if match is None:
+        return None
+    patient_data = match[1]
+    # Check if there's a report ID and fetch the report content
+    if 'Report ID' in patient_data and patient_data['Report ID']:
+        report_content = get_report_content(docs_service, patient_data['Report ID'])
+        patient_data['Report Content'] = report_content
+    return patient_data
+
+# 1-based column index to A1 column letters (1 -> A, 27 -> AA)
+def column_letter(index):
+    letters = ""
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
 # Patient Save/Update Function
 def save_or_update_patient(sheets_service, patient_data):
     try:
-        result = sheets_service.spreadsheets().values().get(spreadsheetId=SHEET_ID, range="A:A").execute()
-        names = result.get('values', [])
-        row_index = next((i for i, name in enumerate(names) if name and name[0] == patient_data["Patient Name"]), None)
-
-        values = [list(patient_data.values())]
-        if row_index is not None:
-            range_name = f'Sheet1!A{row_index + 1}'
+        # Re-read before resolving the row: a cached row number can be up to a minute stale and
+        # point at the wrong patient after another session has written to the sheet
+        load_patients.clear()
+        headers, _, patients, _ = load_patients(sheets_service)
+        match = patients.get(patient_data["Patient Name"])
+
+        # Order values by the sheet's own columns rather than dict insertion order
+        if headers:
+            values = [[patient_data.get(header, "") for header in headers]]
+        else:
+            values = [list(patient_data.values())]
+        if match is not None:
+            # One bounded range write for the whole row
+            row_number = match[0]
+            range_name = f'Sheet1!A{row_number}:{column_letter(len(values[0]))}{row_number}'
             sheets_service.spreadsheets().values().update(
                 spreadsheetId=SHEET_ID,
                 range=range_name,
@@ -100,6 +381,7 @@ def save_or_update_patient(sheets_service, patient_data):
                 valueInputOption="USER_ENTERED",
                 body={"values": values}
             ).execute()
+        load_patients.clear()
         st.success("Patient data saved/updated successfully")
     except Exception as e:
         st.error(f"Error saving/updating patient data: {e}")
@@ -107,12 +389,8 @@ def save_or_update_patient(sheets_service, patient_data):
 # Function to get all patients
 def get_all_patients(sheets_service):
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SHEET_ID,
-            range="A2:A"  # Assuming patient names are in column A, starting from row 2
-        ).execute()
-        values = result.get('values', [])
-        return [name[0] for name in values if name]  # Flatten the list and remove empty entries
+        _, names, _, _ = load_patients(sheets_service)  # Patient names are in column A, starting from row 2
+        return names
     except Exception as e:
         st.error(f"Error fetching patient list: {e}")
         return []
@@ -161,9 +439,6 @@ def save_report_to_docs(docs_service, drive_service, patient_name, report_conten
             }
         ]
 
-        # Debug: Print the size of the content
-        st.write(f"Debug: Report content size: {len(report_content)} characters")
-
         # Try to update the document content
         try:
             docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
@@ -279,92 +554,395 @@ st.markdown(
 
 # --- QUERY & REPORT GENERATION FUNCTIONS ---
 
-def query_weaviate(query_text, top_k=5):
-    if weaviate_client is None:
-        raise ValueError("Weaviate client is not initialized")
-    query_vector = embedding_model.encode(query_text).tolist()
-    near_vector = {"vector": query_vector}
-    results = weaviate_client.query.get("TCMApp", ["text"]).with_near_vector(near_vector).with_limit(top_k).do()
+def normalize_query_text(text):
+    # Collapse whitespace and case (MiniLM is uncased) so formatting-only differences share one cached embedding
+    return " ".join(text.split()).lower()
+
+class EmbeddingCache:
+    """Thread-safe LRU of query embeddings keyed on normalized text."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            vector = self.vectors.get(key)
+            if vector is not None:
+                self.vectors.move_to_end(key)
+            return vector
+
+    def put(self, key, vector):
+        with self.lock:
+            self.vectors[key] = vector
+            self.vectors.move_to_end(key)
+            if len(self.vectors) > self.maxsize:
+                self.vectors.popitem(last=False)
+
+@st.cache_resource
+def get_embedding_cache():
+    # Held as a resource so it survives reruns without st.cache_data pickling every hit
+    return EmbeddingCache(maxsize=512)
+
+def embed_many(texts_norm):
+    # Encode every cache miss in a single batched forward pass
+    embedding_cache = get_embedding_cache()
+    vectors = {text: embedding_cache.get(text) for text in texts_norm}
+    misses = [text for text, vector in vectors.items() if vector is None]
+    if misses:
+        encoded = embedding_model.encode(misses, batch_size=8, convert_to_numpy=True, normalize_embeddings=True)
+        # Convert the whole batch to lists once and cache those, rather than re-boxing every
+        # element on each search that reuses a cached embedding
+        for text, vector in zip(misses, encoded.tolist()):
+            embedding_cache.put(text, vector)
+            vectors[text] = vector
+    return [vectors[text] for text in texts_norm]
+
+# Results are persisted to disk so they survive server restarts. Keys are the normalized query
+# texts, so formatting-only differences share a slot. Persisted caches don't support a TTL, so
+# cache_key is passed explicitly to retire entries from an older index or model.
+@st.cache_data(persist="disk", max_entries=10000, show_spinner=False)
+def search_weaviate(query_texts_norm, top_k, cache_key):
+    query_vectors = embed_many(query_texts_norm)
+    collection = weaviate_client.collections.get("TCMApp")
+
+    # Cosine distance is 1 - similarity, so Weaviate filters out weak matches server-side
+    def search(query_vector):
+        response = collection.query.near_vector(
+            near_vector=query_vector,
+            limit=top_k,
+            distance=1 - MIN_SIMILARITY,
+            return_properties=["text"],
+        )
+        return [{"text": obj.properties.get("text")} for obj in response.objects]
 
-    if 'data' in results and 'Get' in results['data'] and 'TCMApp' in results['data']['Get']:
-        return results['data']['Get']['TCMApp']
-    else:
-        st.error(f"Unexpected response format: {results}")
-        return []
+    # The searches share the client's gRPC channel and run side by side, so the batch still
+    # costs about one round trip. Errors propagate, so a failed search is never cached.
+    with ThreadPoolExecutor(max_workers=len(query_vectors) or 1) as executor:
+        return list(executor.map(search, query_vectors))
 
-def generate_diagnostic_report_part(system_message, user_message, context):
+def query_weaviate_batch(query_texts, top_k=5):
+    # The clients are guaranteed here: start-up calls st.stop() if init_resources fails
     try:
-        response = groq_client.chat.completions.create(
+        return search_weaviate(tuple(normalize_query_text(text) for text in query_texts), top_k, RETRIEVAL_CACHE_KEY)
+    except WeaviateBaseError as e:
+        st.error(f"Error querying Weaviate: {e}")
+        return [[] for _ in query_texts]
+
+def retrieval_text(patient_info, fields=RETRIEVAL_FIELDS):
+    # Canonical field order, so the same clinical picture always produces the same query text.
+    # Select box placeholders like "Not observed" carry no clinical signal and are left out.
+    return " | ".join(
+        f"{field}: {patient_info[field]}" for field in fields
+        if patient_info.get(field) and patient_info[field] not in RETRIEVAL_PLACEHOLDER_VALUES
+    )
+
+def retrieval_fragments(patient_info):
+    fragments = [retrieval_text(patient_info, fields) for fields in RETRIEVAL_FIELD_GROUPS]
+    return [fragment for fragment in fragments if fragment]
+
+def merge_query_results(results_per_query):
+    # Interleave by rank so every facet contributes its best matches first, dropping repeats
+    merged, seen = [], set()
+    for rank_results in zip_longest(*results_per_query):
+        for result in rank_results:
+            if result and result.get('text') and result['text'] not in seen:
+                seen.add(result['text'])
+                merged.append(result)
+    return merged
+
+def build_context(query_results, max_chars=MAX_CONTEXT_CHARS):
+    return "\n".join(result['text'] for result in query_results if result.get('text'))[:max_chars]
+
+RESET_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+RESET_UNIT_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+class RateLimiter:
+    """Token bucket for Groq requests, corrected by the x-ratelimit headers on each response."""
+
+    def __init__(self, max_rate, time_period):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self.tokens = float(max_rate)
+        self.updated_at = time.monotonic()
+        # Set when Groq reports the request quota as spent; no token is handed out before it
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_rate, self.tokens + (now - self.updated_at) * self.max_rate / self.time_period)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            # The bucket is shared by every session's event loop, so guard it with a thread lock
+            # and only ever sleep outside of it
+            with self.lock:
+                blocked_for = self.blocked_until - time.monotonic()
+                if blocked_for <= 0:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) * self.time_period / self.max_rate
+                else:
+                    wait = blocked_for
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        # Only records the quota; the next acquire() waits, so a finished response is never held
+        # back. 429s are retried by the SDK using retry-after.
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is None:
+            return
+        with self.lock:
+            self.tokens = min(self.tokens, float(remaining))
+            if float(remaining) < 1:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + parse_reset_seconds(headers.get("x-ratelimit-reset-requests")))
+
+def parse_reset_seconds(value, default=0.5):
+    # Groq's reset headers are durations like "2m59.56s" or "120ms"; plain seconds are accepted too
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = RESET_DURATION_PATTERN.findall(value)
+    if not parts:
+        return default
+    return sum(float(amount) * RESET_UNIT_SECONDS[unit] for amount, unit in parts)
+
+class ReportSection(BaseModel):
+    # JSON mode guarantees JSON, not this shape; unknown keys must fail rather than be dropped
+    model_config = ConfigDict(extra="forbid")
+
+    paragraphs: list[str] = []
+    bullets: list[str] = []
+
+def parse_report_section(raw_content):
+    if not raw_content or not raw_content.strip():
+        return None  # Nothing to fall back to; reported as a failed section
+    try:
+        section = ReportSection.model_validate_json(raw_content)
+        if section.paragraphs or section.bullets:
+            return section
+    except ValidationError:
+        pass
+
+    # Fall back to the reply's text: the raw reply only if it isn't JSON at all, otherwise the
+    # string values of whatever object came back. Lists of strings become bullets, except a
+    # "paragraphs" list, which keeps its meaning when it arrives next to unexpected keys.
+    try:
+        data = json.loads(raw_content)
+    except json.JSONDecodeError:
+        return ReportSection(paragraphs=[raw_content])
+    paragraphs, bullets = [], []
+    for key, value in (data.items() if isinstance(data, dict) else [(None, data)]):
+        if isinstance(value, str) and value.strip():
+            paragraphs.append(value)
+        elif isinstance(value, list):
+            strings = [item for item in value if isinstance(item, str) and item.strip()]
+            (paragraphs if key == "paragraphs" else bullets).extend(strings)
+    if not (paragraphs or bullets):
+        return None  # JSON with no text in it; reported as a failed section
+    return ReportSection(paragraphs=paragraphs, bullets=bullets)
+
+@st.cache_resource
+def get_rate_limiter():
+    # Shared across sessions since every session uses the same Groq API key
+    return RateLimiter(max_rate=30, time_period=60)
+
+async def generate_diagnostic_report_part(client, base_messages, user_message, context, max_tokens=4000):
+    rate_limiter = get_rate_limiter()
+    try:
+        await rate_limiter.acquire()
+        raw_response = await client.chat.completions.with_raw_response.create(
             model="mixtral-8x7b-32768", 
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": f"Context: {context}\n\nUser Query: {user_message}"}
+            messages=base_messages + [
+                {"role": "user", "content": f"Additional context for this section: {context}\n\n{user_message}" if context else user_message}
             ],
             temperature=0.7,
-            max_tokens=4000,
+            max_tokens=max_tokens,
             top_p=1,
             stop=None,
-            stream=False
+            stream=False,
+            response_format={"type": "json_object"}
         )
-        return response.choices[0].message.content
+        rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
+        return parse_report_section(response.choices[0].message.content)
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
         return None
 
-def generate_diagnostic_report(context, user_input):
-    patient_info = json.loads(user_input)
+REPORT_SYSTEM_PROMPT = """You are a TCM practitioner tasked with generating a diagnostic report. Your knowledge is strictly limited to the information provided in the context. Do not use any external knowledge or make assumptions beyond what is explicitly stated in the context or patient information.
+
+Ensure your report is based solely on the provided context and patient information. If you cannot find relevant information in the context to address a particular aspect of the report, state that there is insufficient information to make a determination on that point.
+
+Respond only with a JSON object of the form {"paragraphs": ["..."], "bullets": ["..."]}, where "paragraphs" holds the prose of the section and "bullets" holds any list items such as points, herbs or recommendations."""
+
+def generate_diagnostic_report(context, patient_info):
+    # Serialized once here for the prompt; the caller passes the dict it already has
+    user_input = json.dumps(patient_info, indent=2)
     patient_name = patient_info.get('Patient Name', 'Patient')
     patient_age = patient_info.get('Age', 'Unknown age')
 
-    system_message = f"""You are a TCM practitioner tasked with generating a diagnostic report. Your knowledge is strictly limited to the information provided in the context. Do not use any external knowledge or make assumptions beyond what is explicitly stated in the context or patient information.
+    # The shared context and patient information are sent once as the opening turns of the
+    # conversation; each section then only adds a short request of its own. The system prompt is
+    # identical for every patient, so who the report is for goes in the user turn after it.
+    base_messages = [
+        {"role": "system", "content": REPORT_SYSTEM_PROMPT},
+        {"role": "user", "content": f"You are generating a report for {patient_name}, a {patient_age}-year-old patient.\n\nContext:\n{context}\n\nPatient Information:\n{user_input}"},
+        {"role": "assistant", "content": "Understood. I will generate each section of the report on request."}
+    ]
 
-    You are generating a report for {patient_name}, a {patient_age}-year-old patient. Ensure your report is based solely on the provided context and patient information. If you cannot find relevant information in the context to address a particular aspect of the report, state that there is insufficient information to make a determination on that point."""
+    report_sections = list(REPORT_SECTION_MAX_TOKENS)
 
-    report_sections = [
-        "1. Patient Overview",
-        "2. TCM Diagnosis",
-        "3. Pattern Differentiation",
-        "4. Treatment Principle and Plan",
-        "5. Acupuncture Point Prescription",
-        "6. Herbal Formula Recommendation",
-        "7. Lifestyle and Dietary Advice",
-        "8. Prognosis and Follow-up Recommendations"
+    patient_query = retrieval_text(patient_info)
+    retrieval_queries = [f"{section}: {patient_query}" for section in report_sections]
+    section_prompts = [
+        f"Based strictly on the patient information and context above, generate the {section} of the TCM diagnostic report. "
+        "Only use information explicitly provided in the context or patient information. If there's insufficient information for any part of this section, clearly state this limitation."
+        for section in report_sections
     ]
 
-    document = Document()
-    document.add_heading(f"TCM Diagnostic Report for {patient_name}", 0)
-
     progress_bar = st.progress(0)
+    # One slot per section, in report order, so each section is shown as soon as it arrives
+    section_placeholders = {section: st.empty() for section in report_sections}
+    with st.spinner("Generating report sections..."):
+        section_contents = asyncio.run(generate_report_sections(base_messages, report_sections, retrieval_queries, section_prompts, context, progress_bar, section_placeholders))
+
+    # Assemble in the original section order regardless of completion order
+    generated_sections = []
+    for section in report_sections:
+        if section_contents.get(section):
+            generated_sections.append((section, section_contents[section]))
+        else:
+            st.warning(f"Failed to generate {section}. Moving to the next section.")
+
+    return generated_sections
+
+async def generate_report_sections(base_messages, report_sections, retrieval_queries, section_prompts, shared_context, progress_bar, section_placeholders):
+    loop = asyncio.get_running_loop()
+    section_contents = {}
+
+    # The batched Weaviate lookup runs in a thread that carries the Streamlit script context;
+    # sections await it only when they need their context, so it overlaps opening the Groq client.
+    with ThreadPoolExecutor(max_workers=1, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+        retrieval = loop.run_in_executor(executor, query_weaviate_batch, retrieval_queries)
+
+        # Only needed once a report is generated, so imported here rather than at cold start
+        import groq
+        import httpx
+
+        # The async client's connection pool is bound to this event loop, so it lives for one report.
+        # Over HTTP/2 the concurrent section requests multiplex on one TLS connection instead of
+        # each paying its own handshake.
+        # 429s are retried by the SDK, which honours retry-after, so no fixed sleep is needed between calls
+        http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=MAX_CONCURRENT_SECTIONS, max_keepalive_connections=MAX_CONCURRENT_SECTIONS), timeout=60.0)
+        async with groq.AsyncGroq(api_key=GROQ_API_KEY, max_retries=3, http_client=http_client) as client:
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_SECTIONS)
+
+            async def generate_section(i, section, section_prompt):
+                # Only send retrieved chunks the shared context doesn't already carry
+                query_results = [result for result in (await retrieval)[i] if not result.get('text') or result['text'] not in shared_context]
+                async with semaphore:
+                    content = await generate_diagnostic_report_part(client, base_messages, section_prompt, build_context(query_results, SECTION_CONTEXT_CHARS), REPORT_SECTION_MAX_TOKENS[section])
+                return section, content
+
+            tasks = [asyncio.create_task(generate_section(i, section, section_prompt)) for i, (section, section_prompt) in enumerate(zip(report_sections, section_prompts))]
+            for completed, task in enumerate(asyncio.as_completed(tasks), start=1):
+                section, content = await task
+                section_contents[section] = content
+                if content:
+                    section_placeholders[section].markdown(section_markdown(section, content))
+                progress_bar.progress(completed / len(tasks), text=f"Generated {section}")
+
+    return section_contents
+
+@dataclass(frozen=True)
+class Report:
+    """A finished report, rendered once for the View Report page and the download button."""
+    text: str
+    docx_bytes: bytes
+    sections: tuple
+
+def report_title(patient_name):
+    return f"TCM Diagnostic Report for {patient_name}"
+
+def section_markdown(section, content):
+    lines = [f"#### {section}", *content.paragraphs, *(f"- {bullet}" for bullet in content.bullets)]
+    return "\n\n".join(lines)
+
+def report_paragraphs(patient_name, generated_sections):
+    # Same paragraph sequence as the .docx: title, then heading and content per section
+    paragraphs = [report_title(patient_name)]
+    for section, content in generated_sections:
+        paragraphs.append(section)
+        paragraphs.extend(content.paragraphs)
+        paragraphs.extend(f"- {bullet}" for bullet in content.bullets)
+    return paragraphs
+
+def docx_paragraph(text, style_id):
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    paragraph = OxmlElement("w:p")
+    properties = OxmlElement("w:pPr")
+    style = OxmlElement("w:pStyle")
+    style.set(qn("w:val"), style_id)
+    properties.append(style)
+    paragraph.append(properties)
+
+    run = OxmlElement("w:r")
+    for i, line in enumerate(text.split("\n")):
+        if i:
+            run.append(OxmlElement("w:br"))
+        text_element = OxmlElement("w:t")
+        text_element.set(qn("xml:space"), "preserve")
+        text_element.text = line
+        run.append(text_element)
+    paragraph.append(run)
+    return paragraph
+
+def build_docx(patient_name, generated_sections):
+    # python-docx (and lxml) load on the first report instead of on every cold start
+    from docx import Document
 
-    for i, section in enumerate(report_sections):
-        user_message = f"""
-        Based strictly on the following patient information and context, generate the {section} of the TCM diagnostic report.
-        Only use information explicitly provided in the context or patient information. If there's insufficient information for any part of this section, clearly state this limitation.
-        Patient Information: {user_input}
-        """
-
-        query_results = query_weaviate(user_message)
-        section_context = "\n".join([result['text'] for result in query_results])
-
-        with st.spinner(f"Generating {section}..."):
-            section_content = generate_diagnostic_report_part(system_message, user_message, section_context)
-            if section_content:
-                document.add_heading(section, level=1)
-                document.add_paragraph(section_content)
-            else:
-                st.warning(f"Failed to generate {section}. Moving to the next section.")
-
-        progress_bar.progress((i + 1) / len(report_sections))
-        time.sleep(1)  # Small delay for better UX
-
-    return document
+    document = Document()
+    styles = document.styles
+    title_style = styles["Title"].style_id
+    heading_style = styles["Heading 1"].style_id
+    body_style = styles["Normal"].style_id
+    bullet_style = styles["List Bullet"].style_id
+
+    # Build every paragraph up front and splice them into the body in one go,
+    # ahead of the trailing section properties
+    elements = [docx_paragraph(report_title(patient_name), title_style)]
+    for section, content in generated_sections:
+        elements.append(docx_paragraph(section, heading_style))
+        elements.extend(docx_paragraph(paragraph, body_style) for paragraph in content.paragraphs)
+        elements.extend(docx_paragraph(bullet, bullet_style) for bullet in content.bullets)
+    body = document.element.body
+    insert_at = body.index(body.sectPr) if body.sectPr is not None else len(body)
+    body[insert_at:insert_at] = elements
+
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
 
 # --- MAIN APP ---
 
-# Initialize resources
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-groq_client = groq.Client(api_key=GROQ_API_KEY)
-sheets_service, docs_service, drive_service = initialize_google_services()
+# Initialize resources (built once per server process, not on every rerun)
+try:
+    weaviate_client, embedding_model = init_resources()
+    sheets_service, docs_service, drive_service = initialize_google_services()
+except Exception as e:
+    st.error(f"Error initializing services: {e}")
+    st.stop()
 
 # Session state for better UX
 if "patient_info" not in st.session_state:
@@ -413,156 +991,119 @@ def patient_info_page():
             else:
                 st.warning(f"No patient found with name '{search_name}'")
 
-    # Basic Information
-    with st.expander("Basic Information", expanded=True):
-        patient_data = st.session_state.get('patient_info', {})
-
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            name = st.text_input("Patient Name", key="name", value=patient_data.get('Patient Name', ''))
-        with col2:
-            gender = st.selectbox("Gender", ["Male", "Female", "Other"], key="gender", index=["Male", "Female", "Other"].index(patient_data.get('Gender', 'Male')))
-        with col3:
-            dob = patient_data.get('Date of Birth (DD/MM/YY)', '')
-            if dob:
-                try:
-                    dob = datetime.datetime.strptime(dob, "%d/%m/%y")
-                except ValueError:
-                    st.error("Invalid date format in stored data. Using default value.")
-                    dob = datetime.datetime.now()
-            else:
-                dob = datetime.datetime.now()
+    # The patient fields live in one form, so editing them doesn't rerun the script;
+    # values are submitted together by the Save / Generate / Clear buttons in main()
+    form = st.form("patient_form")
+    with form:
+        # Basic Information
+        with st.expander("Basic Information", expanded=True):
+            patient_data = st.session_state.get('patient_info', {})
+
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.text_input("Patient Name", key="name", value=patient_data.get('Patient Name', ''))
+            with col2:
+                st.selectbox("Gender", GENDER_OPTIONS, key="gender", index=GENDER_INDEX.get(patient_data.get('Gender'), 0))
+            with col3:
+                dob = patient_data.get('Date of Birth (DD/MM/YY)', '')
+                if dob:
+                    try:
+                        dob = parse_dob(dob)
+                    except ValueError:
+                        st.error("Invalid date format in stored data. Using default value.")
+                        dob = TODAY
+                else:
+                    dob = TODAY
             
-            dob = st.date_input("Date of Birth", value=dob)
-            dob_str = dob.strftime("%d/%m/%y")
-            age = calculate_age(dob)
-            st.write(f"Patient Age: {age} years")
-
-    # Chief Complaint
-    with st.expander("Chief Complaint", expanded=True):
-        col1, col2 = st.columns(2)
-        with col1:
-            chief_complaint = st.text_area("Main Complaint", key="chief_complaint", value=patient_data.get('Chief Complaint', ''))
-        with col2:
-            complaint_duration = st.text_input("Duration of Complaint", key="complaint_duration", value=patient_data.get('Duration of Complaint', ''))
-
-    # TCM Four Diagnostic Methods
-    with st.expander("TCM Four Diagnostic Methods", expanded=True):
-        st.subheader("1. Inspection (望 wàng)")
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            complexion = st.text_input("Complexion", key="complexion", value=patient_data.get('Complexion', ''))
-        with col2:
-            tongue_color_options = ["Not observed", "Pale", "Red", "Dark Red", "Purple", "Bluish Purple"]
-            stored_tongue_color = patient_data.get('Tongue Color', 'Not observed')
-            tongue_color_index = tongue_color_options.index(stored_tongue_color) if stored_tongue_color in tongue_color_options else 0
-            tongue_color = st.selectbox("Tongue Color", tongue_color_options, key="tongue_color", index=tongue_color_index)
-        with col3:
-            tongue_coating_options = ["Not observed", "Thin White", "Thick White", "Yellow", "Grey", "Black"]
-            stored_tongue_coating = patient_data.get('Tongue Coating', 'Not observed')
-            tongue_coating_index = tongue_coating_options.index(stored_tongue_coating) if stored_tongue_coating in tongue_coating_options else 0
-            tongue_coating = st.selectbox("Tongue Coating", tongue_coating_options, key="tongue_coating", index=tongue_coating_index)
-        tongue_shape = st.text_input("Tongue Shape and Features", key="tongue_shape", value=patient_data.get('Tongue Shape and Features', ''))
-
-        st.subheader("2. Auscultation and Olfaction (聞 wén)")
-        col1, col2 = st.columns(2)
-        with col1:
-            voice_sound = st.text_input("Voice Sound", key="voice_sound", value=patient_data.get('Voice Sound', ''))
-        with col2:
-            breath_odor = st.text_input("Breath Odor", key="breath_odor", value=patient_data.get('Breath Odor', ''))
-
-        st.subheader("3. Inquiry (問 wèn)")
-        col1, col2 = st.columns(2)
-        with col1:
-            cold_heat_options = ["Aversion to Cold", "Aversion to Heat", "Alternating Cold and Heat", "Normal"]
-            stored_cold_heat = patient_data.get('Cold/Heat Sensation', 'Normal')
-            cold_heat_index = cold_heat_options.index(stored_cold_heat) if stored_cold_heat in cold_heat_options else 3  # Default to 'Normal'
-            cold_heat_sensation = st.selectbox("Cold/Heat Sensation", cold_heat_options, key="cold_heat_sensation", index=cold_heat_index)
+                # date_input otherwise limits the range to ten years either side of today
+                dob = st.date_input("Date of Birth", key="dob", value=dob, min_value=datetime.date(1900, 1, 1), max_value=TODAY)
+                st.write(f"Patient Age: {calculate_age(dob)} years")
+
+        # Chief Complaint
+        with st.expander("Chief Complaint", expanded=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                st.text_area("Main Complaint", key="chief_complaint", value=patient_data.get('Chief Complaint', ''))
+            with col2:
+                st.text_input("Duration of Complaint", key="complaint_duration", value=patient_data.get('Duration of Complaint', ''))
+
+        # TCM Four Diagnostic Methods
+        with st.expander("TCM Four Diagnostic Methods", expanded=True):
+            st.subheader("1. Inspection (望 wàng)")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.text_input("Complexion", key="complexion", value=patient_data.get('Complexion', ''))
+            with col2:
+                st.selectbox("Tongue Color", TONGUE_COLOR_OPTIONS, key="tongue_color", index=TONGUE_COLOR_INDEX.get(patient_data.get('Tongue Color'), 0))
+            with col3:
+                st.selectbox("Tongue Coating", TONGUE_COATING_OPTIONS, key="tongue_coating", index=TONGUE_COATING_INDEX.get(patient_data.get('Tongue Coating'), 0))
+            st.text_input("Tongue Shape and Features", key="tongue_shape", value=patient_data.get('Tongue Shape and Features', ''))
+
+            st.subheader("2. Auscultation and Olfaction (聞 wén)")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.text_input("Voice Sound", key="voice_sound", value=patient_data.get('Voice Sound', ''))
+            with col2:
+                st.text_input("Breath Odor", key="breath_odor", value=patient_data.get('Breath Odor', ''))
+
+            st.subheader("3. Inquiry (問 wèn)")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.selectbox("Cold/Heat Sensation", COLD_HEAT_OPTIONS, key="cold_heat_sensation", index=COLD_HEAT_INDEX.get(patient_data.get('Cold/Heat Sensation'), COLD_HEAT_INDEX["Normal"]))
             
-            sweating = st.text_input("Sweating", key="sweating", value=patient_data.get('Sweating', ''))
-            appetite = st.text_input("Appetite and Thirst", key="appetite", value=patient_data.get('Appetite and Thirst', ''))
-        with col2:
-            sleep = st.text_input("Sleep Pattern", key="sleep", value=patient_data.get('Sleep Pattern', ''))
-            bowel_movements = st.text_input("Bowel Movements", key="bowel_movements", value=patient_data.get('Bowel Movements', ''))
-            urination = st.text_input("Urination", key="urination", value=patient_data.get('Urination', ''))
-        pain = st.text_area("Pain (location, nature, factors that alleviate or aggravate)", key="pain", value=patient_data.get('Pain (location, nature, factors that alleviate or aggravate)', ''))
-
-        st.subheader("4. Palpation (切 qiè)")
-        col1, col2 = st.columns(2)
-        with col1:
-            stored_pulse_rate = patient_data.get('Pulse Rate (BPM)', '70')
-            try:
-                default_pulse_rate = int(float(stored_pulse_rate))
-                default_pulse_rate = max(40, min(200, default_pulse_rate))  # Ensure it's within the allowed range
-            except ValueError:
-                default_pulse_rate = 70  # Default to 70 if conversion fails
+                st.text_input("Sweating", key="sweating", value=patient_data.get('Sweating', ''))
+                st.text_input("Appetite and Thirst", key="appetite", value=patient_data.get('Appetite and Thirst', ''))
+            with col2:
+                st.text_input("Sleep Pattern", key="sleep", value=patient_data.get('Sleep Pattern', ''))
+                st.text_input("Bowel Movements", key="bowel_movements", value=patient_data.get('Bowel Movements', ''))
+                st.text_input("Urination", key="urination", value=patient_data.get('Urination', ''))
+            st.text_area("Pain (location, nature, factors that alleviate or aggravate)", key="pain", value=patient_data.get('Pain (location, nature, factors that alleviate or aggravate)', ''))
+
+            st.subheader("4. Palpation (切 qiè)")
+            col1, col2 = st.columns(2)
+            with col1:
+                stored_pulse_rate = patient_data.get('Pulse Rate (BPM)', '70')
+                try:
+                    default_pulse_rate = int(float(stored_pulse_rate))
+                    default_pulse_rate = max(40, min(200, default_pulse_rate))  # Ensure it's within the allowed range
+                except ValueError:
+                    default_pulse_rate = 70  # Default to 70 if conversion fails
             
-            pulse_rate = st.number_input("Pulse Rate (BPM)", key="pulse_rate", min_value=40, max_value=200, value=default_pulse_rate)
+                st.number_input("Pulse Rate (BPM)", key="pulse_rate", min_value=40, max_value=200, value=default_pulse_rate)
         
-        with col2:
-            pulse_quality_options = ["Floating", "Sinking", "Slow", "Rapid", "Strong", "Weak", "Wiry", "Slippery", "Rough"]
-            stored_pulse_quality = patient_data.get('Pulse Quality', '')
+            with col2:
+                stored_pulse_quality = patient_data.get('Pulse Quality', '')
 
-            if isinstance(stored_pulse_quality, str):
-                default_pulse_quality = [item.strip() for item in stored_pulse_quality.split(',') if item.strip() in pulse_quality_options]
-            elif isinstance(stored_pulse_quality, list):
-                default_pulse_quality = [item for item in stored_pulse_quality if item in pulse_quality_options]
-            else:
-                default_pulse_quality = []
+                if isinstance(stored_pulse_quality, str):
+                    default_pulse_quality = [item.strip() for item in stored_pulse_quality.split(',') if item.strip() in PULSE_QUALITY_OPTIONS]
+                elif isinstance(stored_pulse_quality, list):
+                    default_pulse_quality = [item for item in stored_pulse_quality if item in PULSE_QUALITY_OPTIONS]
+                else:
+                    default_pulse_quality = []
 
-            pulse_quality = st.multiselect("Pulse Quality", pulse_quality_options, key="pulse_quality", default=default_pulse_quality)
+                st.multiselect("Pulse Quality", PULSE_QUALITY_OPTIONS, key="pulse_quality", default=default_pulse_quality)
 
-    # Additional TCM Diagnostic Information
-    with st.expander("Additional TCM Diagnostic Information", expanded=True):
-        col1, col2 = st.columns(2)
-        with col1:
-            emotions = st.text_area("Emotional State", key="emotions", value=patient_data.get('Emotional State', ''))
-        with col2:
-            lifestyle = st.text_area("Lifestyle Factors (diet, exercise, stress, etc.)", key="lifestyle", value=patient_data.get('Lifestyle Factors (diet, exercise, stress, etc.)', ''))
-        medical_history = st.text_area("Relevant Medical History", key="medical_history", value=patient_data.get('Relevant Medical History', ''))
-
-    # Update session state with current form values
-    st.session_state.patient_info.update({
-        'Patient Name': name,
-        'Date of Birth (DD/MM/YY)': dob_str,
-        'Age': str(age) if age is not None else '',
-        'Gender': gender,
-        'Chief Complaint': chief_complaint,
-        'Duration of Complaint': complaint_duration,
-        'Complexion': complexion,
-        'Tongue Color': tongue_color,
-        'Tongue Coating': tongue_coating,
-        'Tongue Shape and Features': tongue_shape,
-        'Voice Sound': voice_sound,
-        'Breath Odor': breath_odor,
-        'Cold/Heat Sensation': cold_heat_sensation,
-        'Sweating': sweating,
-        'Appetite and Thirst': appetite,
-        'Sleep Pattern': sleep,
-        'Bowel Movements': bowel_movements,
-        'Urination': urination,
-        'Pain (location, nature, factors that alleviate or aggravate)': pain,
-        'Pulse Rate (BPM)': str(pulse_rate),
-        'Pulse Quality': ', '.join(pulse_quality),  # Comma-separated string for multiselect
-        'Emotional State': emotions,
-        'Lifestyle Factors (diet, exercise, stress, etc.)': lifestyle,
-        'Relevant Medical History': medical_history
-    })
+        # Additional TCM Diagnostic Information
+        with st.expander("Additional TCM Diagnostic Information", expanded=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                st.text_area("Emotional State", key="emotions", value=patient_data.get('Emotional State', ''))
+            with col2:
+                st.text_area("Lifestyle Factors (diet, exercise, stress, etc.)", key="lifestyle", value=patient_data.get('Lifestyle Factors (diet, exercise, stress, etc.)', ''))
+            st.text_area("Relevant Medical History", key="medical_history", value=patient_data.get('Relevant Medical History', ''))
+
+    return form
 
 def view_report_page():
     st.title("AcuAssist: TCM Diagnostic Report")
-    if st.session_state.generated_report:
-        doc = st.session_state.generated_report
-        for paragraph in doc.paragraphs:
-            st.write(paragraph.text)
-
-        buffer = BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
+    report = st.session_state.generated_report
+    if report:
+        # One markdown element for the whole report, rendered from text joined at generation time
+        st.markdown(report.text)
 
         st.download_button(
             label="Download Report as Word Document",
-            data=buffer,
+            data=report.docx_bytes,
             file_name="tcm_diagnostic_report.docx",
             mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         )
@@ -574,40 +1115,50 @@ def main():
     page = st.sidebar.radio("Go to", ["Patient Information", "View Report"])
 
     if page == "Patient Information":
-        patient_info_page()
-        
-        col1, col2, col3 = st.columns(3)
+        form = patient_info_page()
+
+        with form:
+            col1, col2, col3 = st.columns(3)
         with col1:
-            if st.button("Save Patient Information"):
+            if st.form_submit_button("Save Patient Information"):
+                sync_patient_info()
                 if 'Patient Name' in st.session_state.patient_info and st.session_state.patient_info['Patient Name']:
                     save_or_update_patient(sheets_service, st.session_state.patient_info)
                 else:
                     st.error("Please enter patient name before saving")
         with col2:
-            if st.button("Generate TCM Diagnostic Report"):
+            if st.form_submit_button("Generate TCM Diagnostic Report"):
+                sync_patient_info()
                 if len(st.session_state.patient_info) > 10:  # Check if enough info is filled
                     try:
+                        # Age was derived from the date widget by sync_patient_info, so the stored DOB isn't re-parsed
                         serializable_patient_info = st.session_state.patient_info.copy()
-                        serializable_patient_info['Age'] = calculate_age(datetime.datetime.strptime(serializable_patient_info['Date of Birth (DD/MM/YY)'], "%d/%m/%y"))
-
-                        user_input = json.dumps(serializable_patient_info, indent=2)
 
                         # Query Weaviate for initial context
-                        query_results = query_weaviate(user_input)
-                        context = "\n".join([result['text'] for result in query_results])
+                        # Each facet is embedded in one batched encode call and searched in one round trip
+                        query_results = merge_query_results(query_weaviate_batch(retrieval_fragments(serializable_patient_info)))
+                        context = build_context(query_results)
 
                         start_time = time.time()
-                        report = generate_diagnostic_report(context, user_input)
+                        report = generate_diagnostic_report(context, serializable_patient_info)
                         end_time = time.time()
 
                         if report:
                             st.success(f"Report generated in {end_time - start_time:.2f} seconds")
-                            st.session_state.generated_report = report
-                            
-                            # Save report to Google Docs
-                            report_content = "\n".join([para.text for para in report.paragraphs])
-                            doc_id, doc_link = save_report_to_docs(docs_service, drive_service, serializable_patient_info['Patient Name'], report_content)
-                            
+                            patient_name = serializable_patient_info['Patient Name']
+                            paragraphs = report_paragraphs(patient_name, report)
+
+                            # Assemble and serialize the .docx in the background while the report is saved to Google Docs
+                            with ThreadPoolExecutor(max_workers=1) as executor:
+                                docx_future = executor.submit(build_docx, patient_name, report)
+                                report_content = "\n".join(paragraphs)
+                                doc_id, doc_link = save_report_to_docs(docs_service, drive_service, patient_name, report_content)
+                                st.session_state.generated_report = Report(
+                                    text="\n\n".join(paragraphs),
+                                    docx_bytes=docx_future.result(),
+                                    sections=tuple(section for section, _ in report),
+                                )
+
                             if doc_id and doc_link:
                                 st.session_state.patient_info['Report ID'] = doc_id
                                 st.session_state.patient_info['Report Link'] = doc_link
@@ -623,7 +1174,7 @@ def main():
                 else:
                     st.warning("Please fill in more patient information before generating a report.")
         with col3:
-            if st.button("Clear Form"):
+            if st.form_submit_button("Clear Form"):
                 clear_patient_data()
                 st.experimental_rerun()  # Refresh the page after clearing
     elif page == "View Report":